@@ -1 +1,2 @@
-from os_calendar_cache import OSCalendarCache
\ No newline at end of file
+from os_calendar_cache import OSCalendarCache
+from settings import OSCalendarSettings
\ No newline at end of file
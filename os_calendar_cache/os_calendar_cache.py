@@ -3,18 +3,29 @@
 from termcolor import colored
 from icalendar import Calendar
 from lxml import etree
-import ConfigParser
+from settings import OSCalendarSettings
 import datetime
 import dateutil.parser
+import difflib
 import filecmp
+import gzip
+import hashlib
 import hmdclogger
+import httplib
+import json
+import logging
+import multiprocessing
 import os
 import pytz
 import re
 import shutil
+import signal
+import socket
 import sys
 import time
+import timeit
 import urllib2
+import zlib
 
 __author__ = "Harvard-MIT Data Center DevOps"
 __copyright__ = "Copyright 2015, HMDC"
@@ -24,6 +35,55 @@ __maintainer__ = "HMDC"
 __email__ = "linux@lists.hmdc.harvard.edu"
 __status__ = "Production"
 
+# Line of the archive's fetches.log: first seen, last seen and hash of a feed.
+# Times are fixed width so the last seen time can be updated in place.
+ARCHIVE_LOG_LINE = "%010d %010d %s\n"
+ARCHIVE_LOG_LINE_LENGTH = len(ARCHIVE_LOG_LINE % (0, 0, "0" * 64))
+ARCHIVE_LOG_PATTERN = re.compile(r'^(\d{10}) (\d{10}) ([0-9a-f]{64})$')
+
+# First two bytes of every gzip file.
+GZIP_MAGIC = '\x1f\x8b'
+
+# Number of bytes to read from the feed at a time while downloading.
+READ_SIZE = 65536
+
+# Matches characters replaced by sanitize_text().
+SANITIZE_PATTERN = re.compile(r'[^\w\s]', re.MULTILINE)
+
+# Matches a whole VEVENT, including its trailing line break.
+VEVENT_PATTERN = re.compile(r'^BEGIN:VEVENT\r?$.*?^END:VEVENT\r?$\n?',
+                            re.MULTILINE | re.DOTALL)
+
+# Instance used by pool workers; set by _init_worker() in each process.
+_worker_cacher = None
+
+
+def _fetch_deadline_exceeded(signum, frame):
+  """Aborts a feed download once its deadline passes (SIGALRM handler)."""
+
+  raise socket.timeout("Fetch deadline exceeded.")
+
+
+def _init_worker(cacher):
+  """Stores the forked OSCalendarCache instance for use by _parse_chunk()."""
+
+  global _worker_cacher
+  _worker_cacher = cacher
+
+
+def _parse_chunk(args):
+  """Parses one chunk of a split ICAL feed inside a pool worker.
+
+  Parameters:
+    args (tuple): The chunk's ICAL text and the number of events before it.
+
+  Returns:
+    outages (list): Outages parsed from the chunk.
+  """
+
+  chunk, offset = args
+  return list(_worker_cacher._parse_events(Calendar.from_ical(chunk), offset))
+
 
 class OSCalendarCache():
   """Module for caching and parsing OpenScholar calendar feeds.
@@ -34,21 +94,39 @@ class OSCalendarCache():
     cacher.get_updates()
 
   Private Functions:
-    _get_settings: Parses the conf file for settings.
+    _get_audiences: Reads the audiences an event applies to.
+    _message_element: Builds the XML element for a console message.
+    _notifications_changed: Compares new notifications to the published ones.
+    _outage_element: Builds the XML element for an outage.
+    _parse_events: Parses the VEVENT components of an ICAL feed.
+    _read_archive_log: Reads the fetch log of a feed archive.
+    _read_feed: Reads a cached ICAL feed, decompressing it if needed.
     _set_logger: Creates a logger.
+    _split_feed: Splits a raw ICAL feed at VEVENT boundaries.
+    _widget_element: Builds the XML element for a widget notification.
+    _write_elements: Incrementally writes elements inside a parent element.
 
   Public Functions:
+    archive_feed: Stores a snapshot of the cached feed in the archive.
     cache_feed: Downloads and caches the calendar ICAL feed.
+    create_error_notifications: Builds error output when the feed is unavailable.
     create_notifications: Builds console and widget output from outage data.
     format_date: Converts unix timestamp to human readable format.
     get_updates: Checks the calendar for updates and outputs notifications feed.
+    index_audiences: Groups sorted outages by the audiences they apply to.
     is_resolved: Searches outage description for the resolved string.
     iso_to_unixtime: Converts ISO8601 datetime to a unix timestamp.
+    iter_ical: Searches the ICAL feed to parse events, one at a time.
     notifications_to_xml: Writes console and widget output to an XML file.
     outages_to_xml: Writes a set of data to a file in XML format.
     parse_ical: Searches the ICAL feed to parse events.
+    prune_archive: Evicts old feed snapshots from the archive.
+    publish_audience_shards: Writes notifications filtered for each audience.
+    reload_settings: Reloads settings if the conf file has changed.
+    replay_snapshots: Runs archived feeds through the pipeline at their fetch times.
     sanitize_text: Replaces non-alphanumeric characters with underscores.
     sort_outages: Sorts outages into one of three categories based on status.
+    timeline_outages: Sorts outages by status at each of many points in time.
     within_grace_period: Allows ICAL download to fail within a grace period.
 
   Class Variables:
@@ -67,53 +145,242 @@ class OSCalendarCache():
 
     Attributes:
       hmdclog (instance): Instance of HMDCLogger for logging.
+      log_handlers (list): Logging handlers added by this instance's logger.
+      logger_options (tuple): Logging arguments, kept to rebuild the logger.
+      settings (instance): Validated snapshot of the conf file.
     """
 
-    self.settings = self._get_settings()
+    self.settings = OSCalendarSettings.load(self.CONFIG_FILE)
+    self.logger_options = (debug_level, log_to_console, log_to_file)
     self.hmdclog = self._set_logger(debug_level, log_to_console, log_to_file)
 
-  def _get_settings(self):
-    """Parses the conf file for settings."""
-
-    config = ConfigParser.ConfigParser()
-    config.read(self.CONFIG_FILE)
-
-    settings = {
-      # Debugging
-      'debug_level': config.get('Debugging', 'debug_level'),
-      'log_file': config.get('Debugging', 'log_file'),
-      # Parsing
-      'resolved_pattern': config.get('Parsing', 'resolved_pattern'),
-      'scope_ahead': config.getint('Parsing', 'scope_ahead'),
-      'scope_past': config.getint('Parsing', 'scope_past'),
-      # States
-      'states': {},
-      # Sources
-      'feed_url': config.get('Sources', 'feed_url'),
-      'url_timeout': config.getint('Sources', 'url_timeout'),
-      'website_url': config.get('Sources', 'website_url'),
-      # WorkingFiles
-      'working_directory': config.get('WorkingFiles', 'working_directory'),
-    }
-
-    for state in ('active', 'completed', 'default', 'error', 'none', 'scheduled'):
-      icon, timeout, urgency = config.get('States', state).split(':')
-      settings['states'][state] = {
-        'icon': icon,
-        'timeout': int(timeout),
-        'urgency': urgency
-      }
-
-    return settings
+  def _get_audiences(self, component):
+    """Reads the audiences an event applies to from the property named by
+    "audience_property" (CATEGORIES by default).
+
+    Parameters:
+      component (object): VEVENT component from the calendar feed.
+
+    Returns:
+      audiences (list): Lowercase, filename safe audience names, in the order
+        they appear; empty if the event applies to everyone.
+    """
+
+    value = component.get(self.settings.audience_property)
+    if value is None:
+      return []
+
+    # The property may appear more than once, each with a list of values.
+    if not isinstance(value, list):
+      value = [value]
+
+    audiences = []
+    for item in value:
+      # icalendar 4+ parses CATEGORIES into a vCategory holding the decoded
+      # values; older releases and other properties give the decoded text.
+      if hasattr(item, 'cats'):
+        names = item.cats
+      else:
+        names = unicode(item).split(",")
+      for name in names:
+        audience = str(re.sub(r'\W+', "_", unicode(name).strip().lower()).strip("_"))
+        if audience and audience not in audiences:
+          audiences.append(audience)
+
+    return audiences
+
+  def _message_element(self, message):
+    """Builds the XML element for one console message."""
+
+    element = etree.Element('message')
+    element.text = message.encode('unicode_escape')
+
+    return element
+
+  def _notifications_changed(self, temp_file, notifications_file):
+    """Compares a newly written notifications file to the published one.
+
+    Parameters:
+      temp_file (string): Full path to the temp XML file of the parsed feed.
+      notifications_file (string): Full path to the notifications file.
+
+    Returns:
+      feed_updated (boolean): Whether the notifications have changed.
+    """
+
+    #
+    # If notifications have not been created previously, force an update;
+    # otherwise compare the new temp XML file to the notifications XML file
+    # to determine if there are any updates (or changes).
+    #
+    if not os.path.isfile(notifications_file):
+      self.hmdclog.log('debug', "No notifications found; forcing update.")
+      return True
+
+    self.hmdclog.log('debug', "Comparing temp file and notifications.")
+    return not filecmp.cmp(temp_file, notifications_file)
+
+  def _outage_element(self, outage):
+    """Builds the XML element for one outage parsed from the calendar feed."""
+
+    item = etree.Element('item')
+
+    title = etree.SubElement(item, 'title')
+    title.text = outage['title'].encode('utf-8')
+
+    link = etree.SubElement(item, 'link')
+    link.text = outage['link'].encode('utf-8')
+
+    resolved = etree.SubElement(item, 'resolved')
+    resolved.text = str(outage['resolved'])
+
+    start_time = etree.SubElement(item, 'start_time')
+    start_time.text = str(outage['start_time'])
+
+    end_time = etree.SubElement(item, 'end_time')
+    end_time.text = str(outage['end_time'])
+
+    mod_time = etree.SubElement(item, 'mod_time')
+    mod_time.text = str(outage['mod_time'])
+
+    return item
+
+  def _parse_events(self, ical_feed, offset=0):
+    """Parses the VEVENT components of an ICAL feed into outages, yielding
+    each one as it is parsed.
+
+    Parameters:
+      ical_feed (object): Calendar object created from the ICAL feed.
+      offset (int): Number of events preceding this feed, for debugging.
+
+    Attributes:
+      counter (int): Numbers events for debugging.
+      audiences (list): Audiences from the event's "audience_property".
+      desc (string): The 'description' from the calendar feed.
+      end_time (int): The 'end time' in unix format from the calendar feed.
+      link (string): The 'URL' from the calendar feed.
+      mod_time (int): The 'modified time' in unix format from the calendar feed.
+      resolved (boolean): If the outage is marked resolved is the description.
+      start_time (int): The 'start time' in unix format from the calendar feed.
+      title (string): The event 'title' from the calendar feed.
+
+    Yields:
+      outage (dictionary): Resulting variables from one parsed event.
+    """
+
+    counter = offset
+
+    for component in ical_feed.walk():
+      if component.name == "VEVENT":
+        counter += 1
+        self.hmdclog.log('debug', "")
+        self.hmdclog.log('debug', "Begin parsing entry #" + str(counter) + ".")
+
+        desc = component.get("DESCRIPTION").encode('utf-8')
+        self.hmdclog.log('debug', "(Description parsed.)")
+
+        end_time = component.get('DTEND').to_ical()
+        end_time = self.iso_to_unixtime("Endtime", end_time)
+
+        link = component.get('URL')
+        self.hmdclog.log('debug', "URL: " + link)
+
+        mod_time = component.get('LAST-MODIFIED').to_ical()
+        mod_time = self.iso_to_unixtime("Modtime", mod_time)
+
+        resolved = self.is_resolved(desc)
+        self.hmdclog.log('debug', "Resolved: " + str(resolved))
+
+        start_time = component.get('DTSTART').to_ical()
+        start_time = self.iso_to_unixtime("Starttime", start_time)
+
+        title = component.get('SUMMARY').encode('utf-8')
+        title = self.sanitize_text("title", title)
+
+        audiences = self._get_audiences(component)
+        self.hmdclog.log('debug', "Audiences: " + ", ".join(audiences))
+
+        self.hmdclog.log('debug', "Done parsing entry #" + str(counter) + ".")
+
+        #
+        # If there's no end time defined, ICAL sets it to be equal to
+        # the start time, which we don't want -- so zero it out.
+        #
+        if end_time == start_time:
+          end_time = "0" * 10
+          self.hmdclog.log('debug', "Found matching start and end time.")
+
+        yield {'audiences': audiences,
+               'end_time': end_time,
+               'link': link,
+               'mod_time': mod_time,
+               'resolved': resolved,
+               'start_time': start_time,
+               'title': title}
+
+  def _read_archive_log(self, archive_directory):
+    """Reads the fetch log of a feed archive. Malformed lines, e.g. one cut
+    short by a crash, are logged and skipped.
+
+    Parameters:
+      archive_directory (string): Location of the feed archive.
+
+    Returns:
+      entries (list): (first seen, last seen, snapshot hash) tuples for each
+        run of fetches of the same feed, oldest first.
+    """
+
+    log_file = archive_directory + "/fetches.log"
+    entries = []
+
+    if os.path.isfile(log_file):
+      with open(log_file, 'r') as file:
+        for line in file:
+          match = ARCHIVE_LOG_PATTERN.match(line)
+          if match is None:
+            self.hmdclog.log('warning', "Skipping malformed line in " + log_file +
+                             ": " + repr(line))
+            continue
+          first_seen, last_seen, digest = match.groups()
+          entries.append((int(first_seen), int(last_seen), digest))
+
+    return entries
+
+  def _read_feed(self, source):
+    """Reads a cached ICAL feed, transparently decompressing gzipped copies.
+
+    Parameters:
+      source (string): Filename with absolute path of the source file.
+
+    Returns:
+      raw_feed (string): Contents of the ICAL feed.
+    """
+
+    if not os.path.isfile(source):
+      raise Exception("Calendar feed not found!")
+
+    with open(source, 'rb') as file:
+      compressed = file.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+      file.seek(0)
+      if compressed:
+        raw_feed = gzip.GzipFile(fileobj=file).read()
+      else:
+        raw_feed = file.read()
+
+    self.hmdclog.log('debug', "Read in file: " + source)
+    return raw_feed
 
   def _set_logger(self, debug_level, log_to_console, log_to_file):
-    """Creates an instance of HMDCLogger with appropriate handlers."""
+    """Creates an instance of HMDCLogger with appropriate handlers. Any
+    handlers that appear on the standard logger of the same name are kept in
+    "log_handlers", so reload_settings() can remove exactly those."""
 
     config_name = self.__class__.__name__
+    existing = list(logging.getLogger(config_name).handlers)
 
     if debug_level is None:
-      hmdclog = hmdclogger.HMDCLogger(config_name, self.settings['debug_level'])
-      hmdclog.log_to_file(self.settings['log_file'])
+      hmdclog = hmdclogger.HMDCLogger(config_name, self.settings.debug_level)
+      hmdclog.log_to_file(self.settings.log_file)
     else:
       hmdclog = hmdclogger.HMDCLogger(config_name, debug_level)
 
@@ -125,52 +392,341 @@ class OSCalendarCache():
       if log_to_console:
         hmdclog.log_to_console()
       if log_to_file:
-        hmdclog.log_to_file(self.settings['log_file'])
+        hmdclog.log_to_file(self.settings.log_file)
+
+    self.log_handlers = [handler for handler in logging.getLogger(config_name).handlers
+                         if handler not in existing]
 
     return hmdclog
 
-  def cache_feed(self, cache_file, feed_url, within_grace_period):
+  def _split_feed(self, raw_feed):
+    """Splits a raw ICAL feed at VEVENT boundaries.
+
+    Parameters:
+      raw_feed (string): Contents of the ICAL feed.
+
+    Returns:
+      prologue (string): Everything before the first event (VCALENDAR
+        properties, timezones, etc.), followed by any other components
+        found between events.
+      events (list): The raw text of each VEVENT, in feed order.
+      epilogue (string): Everything after the last event.
+    """
+
+    matches = list(VEVENT_PATTERN.finditer(raw_feed))
+
+    if not matches:
+      return raw_feed, [], ""
+
+    prologue = raw_feed[:matches[0].start()]
+    events = [match.group(0) for match in matches]
+    epilogue = raw_feed[matches[-1].end():]
+
+    #
+    # Components between events (e.g. a VTIMEZONE after the first VEVENT)
+    # are kept with the prologue so that every chunk still carries them.
+    #
+    for previous, match in zip(matches, matches[1:]):
+      gap = raw_feed[previous.end():match.start()]
+      if gap.strip():
+        prologue += gap
+
+    return prologue, events, epilogue
+
+  def _widget_element(self, outage):
+    """Builds the XML element for one widget notification."""
+
+    widget = etree.Element('widget')
+
+    title = etree.SubElement(widget, 'title')
+    title.text = outage['title']
+
+    icon = etree.SubElement(widget, 'icon')
+    icon.text = outage['icon']
+
+    tooltip = etree.SubElement(widget, 'tooltip')
+    tooltip.text = outage['tooltip']
+
+    timeout = etree.SubElement(widget, 'timeout')
+    timeout.text = str(outage['timeout'])
+
+    urgency = etree.SubElement(widget, 'urgency')
+    urgency.text = outage['urgency']
+
+    return widget
+
+  def _write_elements(self, xf, tag, elements):
+    """Incrementally writes elements inside a parent element.
+
+    Parameters:
+      xf (object): lxml incremental XML writer.
+      tag (string): Name of the parent element.
+      elements (iterable): Child elements, written as they are produced.
+    """
+
+    elements = iter(elements)
+    first = next(elements, None)
+
+    #
+    # An empty parent is written as a whole element so that it serializes
+    # as "<tag/>", the same as ElementTree.write() does.
+    #
+    if first is None:
+      xf.write(etree.Element(tag))
+      return
+
+    with xf.element(tag):
+      xf.write(first)
+      for element in elements:
+        xf.write(element)
+
+  def archive_feed(self, cache_file, archive_directory, fetched=None):
+    """Stores a snapshot of the cached feed in a content addressed archive.
+    Each distinct feed is stored once, gzipped and named by its SHA-256
+    hash. fetches.log is run-length encoded: a fetch of the same feed as the
+    last one only updates that line's last seen time, so the log grows with
+    feed changes rather than with polls.
+
+    Parameters:
+      cache_file (string): Full path to the cache file.
+      archive_directory (string): Location of the feed archive.
+      fetched (int): Time of the fetch; defaults to the cache file's mtime.
+
+    Attributes:
+      digest (string): SHA-256 hash of the feed contents.
+      last_line (string): Last line of fetches.log, and the byte before it.
+      raw_feed (string): Contents of the cached feed.
+      snapshot_file (string): Full path to the archived snapshot.
+
+    Returns:
+      digest (string): SHA-256 hash of the feed contents.
+    """
+
+    snapshot_directory = archive_directory + "/snapshots"
+    if not os.path.isdir(snapshot_directory):
+      os.makedirs(snapshot_directory)
+
+    if fetched is None:
+      fetched = int(os.path.getmtime(cache_file))
+
+    raw_feed = self._read_feed(cache_file)
+    digest = hashlib.sha256(raw_feed).hexdigest()
+    snapshot_file = snapshot_directory + "/" + digest + ".ics.gz"
+
+    if os.path.isfile(snapshot_file):
+      self.hmdclog.log('debug', "Snapshot already archived: " + digest)
+    else:
+      file = gzip.open(snapshot_file + ".tmp", 'wb')
+      with file:
+        file.write(raw_feed)
+      shutil.move(snapshot_file + ".tmp", snapshot_file)
+      self.hmdclog.log('info', "Archived new snapshot: " + digest)
+
+    log_file = archive_directory + "/fetches.log"
+    last_line = ""
+    if os.path.isfile(log_file):
+      with open(log_file, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        file.seek(max(file.tell() - ARCHIVE_LOG_LINE_LENGTH - 1, 0))
+        last_line = file.read()
+
+    #
+    # Only update the last line in place if it is whole and well formed,
+    # otherwise a damaged line would be overwritten at the wrong offset.
+    #
+    intact = (last_line.endswith("\n") and
+              len(last_line) >= ARCHIVE_LOG_LINE_LENGTH and
+              last_line[:-ARCHIVE_LOG_LINE_LENGTH] in ("", "\n") and
+              ARCHIVE_LOG_PATTERN.match(last_line[-ARCHIVE_LOG_LINE_LENGTH:]))
+
+    if intact and last_line[-65:-1] == digest:
+      with open(log_file, 'r+b') as file:
+        # Skip the first seen time and its separator on the last line.
+        file.seek(-ARCHIVE_LOG_LINE_LENGTH + 11, os.SEEK_END)
+        file.write("%010d" % fetched)
+    else:
+      with open(log_file, 'a') as file:
+        # Start a new line after a truncated one instead of joining them.
+        if last_line and not last_line.endswith("\n"):
+          file.write("\n")
+        file.write(ARCHIVE_LOG_LINE % (fetched, fetched, digest))
+
+    return digest
+
+  def cache_feed(self, cache_file, feed_url, within_grace_period, deadline=0):
     """Downloads and caches the calendar ICAL feed.
 
+    The feed is requested with gzip/deflate transfer encoding and decompressed
+    as it streams in. If "compress_cache" is set, the cached copy is stored
+    gzipped; parse_ical() reads either form.
+
     Parameters:
       cache_file (string): Full path to the cache file to save to.
       feed_url (string): URL of the OpenScholar ICAL feed.
       within_grace_period (boolean): If still within the grace period for no
         OpenScholar connectivity.
+      deadline (int): Seconds the whole download may take; 0 for no deadline.
+        It is enforced with a SIGALRM watchdog, which interrupts the download
+        however slowly the server trickles data. Outside the main thread
+        signals are unavailable, and only each socket operation is bounded.
 
     Attributes:
+      decompressor (object): zlib decompressor for the transfer encoding.
+      encoding (string): Content-Encoding of the response.
       feed (object): File handler of the calendar feed.
+      head (string): Start of a deflate response, kept until its format is
+        known.
+      previous_handler (object): SIGALRM handler to restore after the download.
+      request (object): Request for the feed, with the accepted encodings.
+      temp_cache (string): Full path to the partially downloaded cache file.
+      watchdog (boolean): If the deadline is enforced with SIGALRM.
     """
 
     connection_msg = "Unable to connect to OpenScholar: " + feed_url
     timeout_msg = "Cannot download " + feed_url + ", but within grace period."
+    temp_cache = cache_file + ".tmp"
+    watchdog = False
+
+    if deadline:
+      try:
+        previous_handler = signal.signal(signal.SIGALRM, _fetch_deadline_exceeded)
+        watchdog = True
+      except ValueError:
+        self.hmdclog.log('warning', "Fetch deadline only bounds socket operations "
+                         "outside the main thread.")
 
     try:
-      feed = urllib2.urlopen(feed_url)
-      with open(cache_file, 'wb') as file:
-        file.write(feed.read())
+      try:
+        if watchdog:
+          signal.setitimer(signal.ITIMER_REAL, deadline)
+
+        request = urllib2.Request(feed_url, headers={'Accept-Encoding': 'gzip, deflate'})
+        if deadline:
+          feed = urllib2.urlopen(request, timeout=deadline)
+        else:
+          feed = urllib2.urlopen(request)
+
+        encoding = (feed.info().getheader('Content-Encoding') or "").strip().lower()
+        self.hmdclog.log('debug', "Content-Encoding: " + encoding)
+        if encoding == 'gzip':
+          decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+          decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+        else:
+          decompressor = None
+        # Many servers send raw deflate without the zlib header, which is only
+        # detectable once its first two bytes have arrived.
+        head = "" if encoding == 'deflate' else None
+
+        #
+        # Download to a temp file so a failed transfer doesn't clobber the
+        # last good copy of the feed.
+        #
+        if self.settings.compress_cache:
+          file = gzip.open(temp_cache, 'wb')
+        else:
+          file = open(temp_cache, 'wb')
+        with file:
+          while True:
+            chunk = feed.read(READ_SIZE)
+            if not chunk:
+              break
+            if head is not None:
+              head += chunk
+              try:
+                chunk = decompressor.decompress(chunk)
+              except zlib.error:
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                chunk = decompressor.decompress(head)
+              if len(head) >= 2:
+                head = None
+            elif decompressor is not None:
+              chunk = decompressor.decompress(chunk)
+            file.write(chunk)
+          if decompressor is not None:
+            file.write(decompressor.flush())
+      finally:
+        # Disarm before anything else so the alarm can't fire in a handler.
+        if watchdog:
+          signal.setitimer(signal.ITIMER_REAL, 0)
+          signal.signal(signal.SIGALRM, previous_handler)
+
+      shutil.move(temp_cache, cache_file)
       self.hmdclog.log('debug', "Successfully wrote: " + cache_file)
     #
     # There was an error connecting or download the feed, catch it here but
     # only if it's past the grace period.
     #
-    except urllib2.HTTPError, e:
-      if not within_grace_period:
-        self.hmdclog.log('error', connection_msg)
-        raise Exception(connection_msg)
-      else:
-        self.hmdclog.log('warning', timeout_msg)
-        return False
-    except urllib2.URLError, e:
+    except (urllib2.HTTPError, urllib2.URLError, httplib.HTTPException,
+            socket.error, zlib.error), e:
+      self.hmdclog.log('debug', "Download failed: " + str(e))
       if not within_grace_period:
         self.hmdclog.log('error', connection_msg)
         raise Exception(connection_msg)
       else:
         self.hmdclog.log('warning', timeout_msg)
         return False
+    finally:
+      # Never leave a partial download behind, whatever went wrong.
+      if os.path.isfile(temp_cache):
+        os.remove(temp_cache)
 
     return True
 
+  def create_error_notifications(self, last_fetched):
+    """Creates notification output for console and widgets when the calendar
+    feed could not be retrieved within the grace period.
+
+    Arguments:
+      last_fetched (int): Unix timestamp of the last good download, or 0.
+
+    Attributes:
+      error_text (string): Description of the error.
+      icon (string): Icon to use with the error status.
+      timeout (int): Time to keep the widget displayed (milliseconds).
+      title (string): Name of the widget.
+      tooltip (string): Formatted text to display on the widget or console.
+      urgency (string): Urgency level used by NOTIFY_SEND.
+
+    Returns:
+      output (dictionary): GUI and console output sorted into lists.
+    """
+
+    cli_text = "Please see the following URL for more information:"
+    gui_text = "Right click the outages toolbar icon for more information."
+    link_color = 'blue'
+    output = {'gui': [], 'console': []}
+
+    title = "Outage information unavailable"
+    if last_fetched:
+      error_text = "Outage information has not been updated since " + \
+        self.format_date(last_fetched, 'last_fetched') + "."
+    else:
+      error_text = "Outage information could not be retrieved."
+
+    #
+    # GUI output
+    #
+    icon = self.settings.states['error']['icon']
+    tooltip = error_text + "\n" + gui_text
+    timeout = self.settings.states['error']['timeout']
+    urgency = self.settings.states['error']['urgency']
+
+    output['gui'].append({'icon': icon, 'tooltip': tooltip, 'timeout': timeout,
+                'title': title, 'urgency': urgency})
+
+    #
+    # Console output
+    #
+    link = colored(self.settings.website_url, link_color)
+    text = colored(error_text, 'red', attrs=['bold'])
+    tooltip = text + "\n" + cli_text + "\n\t" + link + "\n"
+    output['console'].append(tooltip)
+
+    self.hmdclog.log('info', "Created output for unavailable feed.")
+
+    return output
+
   def create_notifications(self, sorted_outages):
     """Creates notification output for console and widgets based on status.
 
@@ -215,10 +771,10 @@ class OSCalendarCache():
       #
       # GUI output
       #
-      icon = self.settings['states']['completed']['icon']
+      icon = self.settings.states['completed']['icon']
       tooltip = complete_text + "\n" + gui_text
-      timeout = self.settings['states']['completed']['timeout']
-      urgency = self.settings['states']['completed']['urgency']
+      timeout = self.settings.states['completed']['timeout']
+      urgency = self.settings.states['completed']['urgency']
 
       output['gui'].append({'icon': icon, 'tooltip': tooltip, 'timeout': timeout,
                   'title': title, 'urgency': urgency})
@@ -258,10 +814,10 @@ class OSCalendarCache():
       #
       # GUI output
       #
-      icon = self.settings['states']['scheduled']['icon']
+      icon = self.settings.states['scheduled']['icon']
       tooltip = scheduled_text + "\n" + scheduled['link'] + "\n" + gui_text
-      timeout = self.settings['states']['scheduled']['timeout']
-      urgency = self.settings['states']['scheduled']['urgency']
+      timeout = self.settings.states['scheduled']['timeout']
+      urgency = self.settings.states['scheduled']['urgency']
 
       output['gui'].append({'icon': icon, 'tooltip': tooltip, 'timeout': timeout,
                   'title': title, 'urgency': urgency})
@@ -307,9 +863,9 @@ class OSCalendarCache():
       #
       # GUI output
       #
-      icon = self.settings['states']['active']['icon']
-      timeout = self.settings['states']['active']['timeout']
-      urgency = self.settings['states']['active']['urgency']
+      icon = self.settings.states['active']['icon']
+      timeout = self.settings.states['active']['timeout']
+      urgency = self.settings.states['active']['urgency']
       tooltip = active_text + "." + "\n" + gui_text
 
       output['gui'].append({'icon': icon, 'tooltip': tooltip, 'timeout': timeout,
@@ -350,6 +906,13 @@ class OSCalendarCache():
     """Detect updates by parsing a cached calendar feed to a temp file and
     comparing that to the existing notifications feed.
 
+    With "stale_while_revalidate" set, a failed or slow download never raises:
+    notifications keep being built from the last good cache file until the
+    grace period runs out, after which an "error" widget is published. The
+    time of the last good download, its age, and whether it is stale are
+    written to status.json on every run, apart from the notifications so that
+    they are only replaced when they change.
+
     Attributes:
       cache_file (string): Full path to the cache file.
       cached (boolean): If caching calendar feed succeeded or not.
@@ -357,24 +920,37 @@ class OSCalendarCache():
       feed (object): File handler of the calendar feed.
       feed_updated (boolean): Whether the feed has been updated or not.
       feed_url_safe (string): Filename safe url of the feed.
+      last_fetched (int): Time of the last good download of the feed.
       parsed_file (string): Full path to the XML file of the parsed feed.
+      shard_directory (string): Location of the per-audience notifications.
       outages (dictionary): Results from parsing the calendar feed.
       notifications_file (string): Full path to the notifications file.
+      status (dictionary): Staleness of the published notifications.
+      status_file (string): Full path to the status of the notifications.
+      stale_while_revalidate (boolean): Serve stale notifications, then an
+        error, instead of raising when the feed is unavailable.
       temp_file (string): Full path to the temp XML file of the parsed feed.
       within_grace_period (boolean): If still within the grace period for no
         OpenScholar connectivity.
     """
 
+    self.reload_settings()
+
     #
     # Set up file locations for sources and outputs.
     #
-    directory = self.settings['working_directory']
-    feed_url_safe = self.sanitize_text("feed_url_safe", self.settings['feed_url'])
+    directory = self.settings.working_directory
+    feed_url_safe = self.sanitize_text("feed_url_safe", self.settings.feed_url)
     cache_file = directory + "/" + feed_url_safe + ".ics"
+    if self.settings.compress_cache:
+      cache_file += ".gz"
     notifications_file = directory + "/notifications.xml"
+    shard_directory = directory + "/audiences"
+    status_file = directory + "/status.json"
     temp_file = directory + "/notifications-new.xml"
+    stale_while_revalidate = self.settings.stale_while_revalidate
 
-    self.hmdclog.log('debug', "Calendar feed: " + self.settings['feed_url'])
+    self.hmdclog.log('debug', "Calendar feed: " + self.settings.feed_url)
     self.hmdclog.log('debug', "Files:")
     self.hmdclog.log('debug', "\tCache: " + cache_file)
     self.hmdclog.log('debug', "\tTemp: " + temp_file)
@@ -384,33 +960,82 @@ class OSCalendarCache():
     # Determines if the last cache file was downloaded within the grace
     # period by comparing the timeout setting to the cache file's mtime.
     #
-    within_grace_period = self.within_grace_period(cache_file, self.settings['url_timeout'])
+    within_grace_period = self.within_grace_period(cache_file, self.settings.url_timeout)
     self.hmdclog.log('debug', "Within grace period: " + str(within_grace_period))
 
     #
-    # Download a new copy of the calendar feed into a cache file.
+    # Download a new copy of the calendar feed into a cache file. Past the
+    # grace period this raises, unless stale notifications are allowed.
+    #
+    try:
+      cached = self.cache_feed(cache_file, self.settings.feed_url,
+                               within_grace_period, self.settings.fetch_deadline)
+    except Exception, e:
+      if not stale_while_revalidate:
+        raise
+      self.hmdclog.log('error', "Serving cached notifications; download failed: " +
+                       str(e))
+      cached = False
+
+    #
+    # Keep a copy of every distinct feed that was served, for debugging.
+    # Failures here are logged but never stop notifications from publishing.
     #
-    cached = self.cache_feed(cache_file, self.settings['feed_url'], within_grace_period)
+    if cached and self.settings.archive_directory:
+      try:
+        self.archive_feed(cache_file, self.settings.archive_directory)
+        self.prune_archive(self.settings.archive_directory,
+                           self.settings.archive_max_age,
+                           self.settings.archive_max_size)
+      except (IOError, OSError, ValueError), e:
+        self.hmdclog.log('error', "Unable to archive the feed: " + str(e))
+
+    if stale_while_revalidate:
+      now = int(time.time())
+      if os.path.isfile(cache_file):
+        last_fetched = int(os.path.getmtime(cache_file))
+      else:
+        last_fetched = 0
+      status = {'age': now - last_fetched if last_fetched else 0,
+                'fetched': last_fetched,
+                'stale': not cached}
+      self.hmdclog.log('debug', "Status: " + str(status))
+
+      with open(status_file + ".new", 'w') as file:
+        json.dump(status, file, indent=2, sort_keys=True)
+      shutil.move(status_file + ".new", status_file)
 
-    if cached:
+      if cached or (within_grace_period and last_fetched):
+        #
+        # Rebuild from the freshly downloaded feed or, if the download
+        # failed, from the last good copy so outages still change state.
+        #
+        outages = self.parse_ical(cache_file)
+        sorted_outages = self.sort_outages(outages)
+        notifications = self.create_notifications(sorted_outages)
+        if self.settings.audience_shards:
+          self.publish_audience_shards(shard_directory, sorted_outages)
+      else:
+        self.hmdclog.log('error', "Grace period expired; publishing error state.")
+        notifications = self.create_error_notifications(last_fetched)
+        if self.settings.audience_shards:
+          self.publish_audience_shards(shard_directory, None, notifications)
+
+      self.notifications_to_xml(notifications, temp_file,
+                                incremental=self.settings.incremental_xml)
+      feed_updated = self._notifications_changed(temp_file, notifications_file)
+    elif cached:
       #
       # Parse the cache file into outages, then notifications.
       #
       outages = self.parse_ical(cache_file)
       sorted_outages = self.sort_outages(outages)
       notifications = self.create_notifications(sorted_outages)
-      self.notifications_to_xml(notifications, temp_file)
-      #
-      # If notifications have not been created previously, force an update;
-      # otherwise compare the new temp XML file to the notifications XML file
-      # to determine if there are any updates (or changes).
-      #
-      if not os.path.isfile(notifications_file):
-        self.hmdclog.log('debug', "No notifications found; forcing update.")
-        feed_updated = True
-      else:
-        self.hmdclog.log('debug', "Comparing temp file and notifications.")
-        feed_updated = not filecmp.cmp(temp_file, notifications_file)
+      self.notifications_to_xml(notifications, temp_file,
+                                incremental=self.settings.incremental_xml)
+      if self.settings.audience_shards:
+        self.publish_audience_shards(shard_directory, sorted_outages)
+      feed_updated = self._notifications_changed(temp_file, notifications_file)
     else:
       feed_updated = False
 
@@ -431,6 +1056,41 @@ class OSCalendarCache():
         except OSError, e:
           self.hmdclog.log('error', "Error deleting " + temp_file)
 
+  def index_audiences(self, sorted_outages, audiences=()):
+    """Builds an inverted index from audience to the sorted outages that
+    apply to it. Outages without any audience apply to every audience.
+
+    Parameters:
+      sorted_outages (dictionary): Outages sorted into groups.
+      audiences (list): Additional audiences to include even if no outage
+        names them, e.g. those with previously published shards.
+
+    Returns:
+      index (dictionary): Outages sorted into groups, for each audience.
+    """
+
+    index = {}
+    for audience in audiences:
+      index[audience] = {'completed': [], 'scheduled': [], 'active': []}
+    for group in sorted_outages.values():
+      for outage in group:
+        for audience in outage.get('audiences', []):
+          if audience not in index:
+            index[audience] = {'completed': [], 'scheduled': [], 'active': []}
+
+    #
+    # Walk each group in order so every audience keeps the same ordering of
+    # outages as the global notifications.
+    #
+    for state, group in sorted_outages.items():
+      for outage in group:
+        members = outage.get('audiences') or index.keys()
+        for audience in members:
+          index[audience][state].append(outage)
+
+    self.hmdclog.log('debug', "Indexed " + str(len(index)) + " audiences.")
+    return index
+
   def is_resolved(self, description):
     """Attempts to find the resolved string with regex.
 
@@ -439,16 +1099,16 @@ class OSCalendarCache():
 
     Attributes:
         matches (object): Result of searching for resolved pattern.
-        resolved_regex (string): Resolved string in regex form.
+        regex (object): Resolved string in compiled regex form.
 
     Returns:
         matched (boolean): If the resolved string is present.
     """
 
-    resolved_regex = "(.*)(" + self.settings['resolved_pattern'] + ")(.*)"
-    self.hmdclog.log('debug', "Resolved regex: " + resolved_regex)
+    # Compiled once from "resolved_pattern" when the settings were loaded.
+    regex = self.settings.resolved_regex
+    self.hmdclog.log('debug', "Resolved regex: " + regex.pattern)
 
-    regex = re.compile(resolved_regex, re.MULTILINE)
     # Cast to bool to get True or False -- we don't want the actual string.
     matched = bool(regex.search(description))
 
@@ -473,67 +1133,124 @@ class OSCalendarCache():
                      " converted to " + str(timestamp))
     return timestamp
 
-  def notifications_to_xml(self, notifications, output_file):
-    """Writes an XML file from the outages parsed from the calendar feed.
+  def iter_ical(self, source):
+    """Parses an iCal feed for events, yielding outages in feed order.
+
+    Feeds with at least "parallel_threshold" events are split into chunks at
+    VEVENT boundaries and parsed in a process pool; smaller feeds (or a
+    threshold of 0) are parsed serially to avoid the pool startup overhead.
 
     Parameters:
-        notifications (dictionary): Notifications created from parsed outages.
-        output_file (string): Full path to the output file.
+      source (string): Filename with absolute path of the source file.
 
     Attributes:
-        counter (int): Enumerates data items for debugging.
-        root (object): Top element in the XML tree.
-        tree (object): Wrapper to save elements in XML format.
+      chunk_size (int): Number of events handed to each worker at once.
+      chunks (list): Standalone ICAL feeds, each holding a slice of events.
+      raw_feed (string): Contents of the source file.
+      threshold (int): Minimum number of events to parse in parallel.
+      workers (int): Number of worker processes in the pool.
+
+    Yields:
+      outage (dictionary): Resulting variables from one parsed event.
     """
 
-    root = etree.Element('notifications')
-    tree = etree.ElementTree(root)
-    self.hmdclog.log('debug', "")
+    raw_feed = self._read_feed(source)
 
-    counter = 0
-    messages = etree.SubElement(root, 'messages')
-    for outage in notifications['console']:
-      counter += 1
-      self.hmdclog.log('debug', "Adding message #" + str(counter) + ".")
+    threshold = self.settings.parallel_threshold
+    prologue, events, epilogue = self._split_feed(raw_feed)
 
-      message = etree.SubElement(messages, 'message')
-      message.text = outage.encode('unicode_escape')
+    if threshold <= 0 or len(events) < threshold:
+      self.hmdclog.log('debug', "Parsing " + str(len(events)) + " events serially.")
+      for outage in self._parse_events(Calendar.from_ical(raw_feed)):
+        yield outage
+      return
 
-    counter = 0
-    widgets = etree.SubElement(root, 'widgets')
-    for outage in notifications['gui']:
-      counter += 1
-      self.hmdclog.log('debug', "Adding widget #" + str(counter) + ".")
+    workers = self.settings.parallel_workers or multiprocessing.cpu_count()
+    chunk_size = -(-len(events) // workers)
+    self.hmdclog.log('debug', "Parsing " + str(len(events)) + " events with " +
+                     str(workers) + " workers.")
+
+    #
+    # Each chunk is a complete feed so that the workers can parse it on its
+    # own. The offsets keep the debugging entry numbers the same as a
+    # serial run.
+    #
+    chunks = []
+    for offset in range(0, len(events), chunk_size):
+      chunk = prologue + "".join(events[offset:offset + chunk_size]) + epilogue
+      chunks.append((chunk, offset))
 
-      widget = etree.SubElement(widgets, 'widget')
+    pool = multiprocessing.Pool(workers, _init_worker, (self,))
+    try:
+      # imap() returns results in the order of the chunks, not of completion.
+      for result in pool.imap(_parse_chunk, chunks):
+        for outage in result:
+          yield outage
+    finally:
+      pool.close()
+      pool.join()
+
+  def notifications_to_xml(self, notifications, output_file, incremental=False):
+    """Writes an XML file from the outages parsed from the calendar feed.
+
+    Parameters:
+        notifications (dictionary): Notifications created from parsed outages;
+          the "console" and "gui" entries may be lists or generators.
+        output_file (string): Full path to the output file.
+        incremental (boolean): Write each element as it is produced instead of
+          building the whole tree first. The output is not pretty printed.
 
-      title = etree.SubElement(widget, 'title')
-      title.text = outage['title']
+    Attributes:
+        counter (int): Enumerates data items for debugging.
+        root (object): Top element in the XML tree.
+        tree (object): Wrapper to save elements in XML format.
+    """
 
-      icon = etree.SubElement(widget, 'icon')
-      icon.text = outage['icon']
+    self.hmdclog.log('debug', "")
 
-      tooltip = etree.SubElement(widget, 'tooltip')
-      tooltip.text = outage['tooltip']
+    def messages():
+      counter = 0
+      for outage in notifications['console']:
+        counter += 1
+        self.hmdclog.log('debug', "Adding message #" + str(counter) + ".")
+        yield self._message_element(outage)
 
-      timeout = etree.SubElement(widget, 'timeout')
-      timeout.text = str(outage['timeout'])
+    def widgets():
+      counter = 0
+      for outage in notifications['gui']:
+        counter += 1
+        self.hmdclog.log('debug', "Adding widget #" + str(counter) + ".")
+        yield self._widget_element(outage)
+
+    if incremental:
+      with open(output_file, 'w') as file:
+        with etree.xmlfile(file) as xf:
+          xf.write_declaration()
+          with xf.element('notifications'):
+            self._write_elements(xf, 'messages', messages())
+            self._write_elements(xf, 'widgets', widgets())
+    else:
+      root = etree.Element('notifications')
+      tree = etree.ElementTree(root)
+      etree.SubElement(root, 'messages').extend(messages())
+      etree.SubElement(root, 'widgets').extend(widgets())
 
-      urgency = etree.SubElement(widget, 'urgency')
-      urgency.text = outage['urgency']
+      with open(output_file, 'w') as file:
+        # The "pretty_print" parameter writes the XML in tree form.
+        tree.write(file, pretty_print=True, xml_declaration=True)
 
-    with open(output_file, 'w') as file:
-      # The "pretty_print" parameter writes the XML in tree form.
-      tree.write(file, pretty_print=True, xml_declaration=True)
     self.hmdclog.log('debug', "")
     self.hmdclog.log('info', "Wrote " + output_file)
 
-  def outages_to_xml(self, outages, output_file):
+  def outages_to_xml(self, outages, output_file, incremental=False):
     """Writes an XML file from the data parsed from the calendar feed.
 
     Parameters:
-        outages (dictionary): Outages parsed from the calendar feed.
+        outages (list): Outages parsed from the calendar feed; may be a
+          generator such as iter_ical().
         output_file (string): Full path to the output file.
+        incremental (boolean): Write each element as it is produced instead of
+          building the whole tree first. The output is not pretty printed.
 
     Attributes:
         counter (int): Enumerates data items for debugging.
@@ -541,38 +1258,29 @@ class OSCalendarCache():
         tree (object): Wrapper to save elements in XML format.
     """
 
-    counter = 0
     self.hmdclog.log('debug', "")
-    root = etree.Element('events')
-    tree = etree.ElementTree(root)
-
-    for outage in outages:
-      counter += 1
-      self.hmdclog.log('debug', "Creating subelements for outage #" + str(counter) + ".")
 
-      item = etree.SubElement(root, 'item')
-
-      title = etree.SubElement(item, 'title')
-      title.text = outage['title'].encode('utf-8')
-
-      link = etree.SubElement(item, 'link')
-      link.text = outage['link'].encode('utf-8')
-
-      resolved = etree.SubElement(item, 'resolved')
-      resolved.text = str(outage['resolved'])
-
-      start_time = etree.SubElement(item, 'start_time')
-      start_time.text = str(outage['start_time'])
-
-      end_time = etree.SubElement(item, 'end_time')
-      end_time.text = str(outage['end_time'])
+    def items():
+      counter = 0
+      for outage in outages:
+        counter += 1
+        self.hmdclog.log('debug', "Creating subelements for outage #" + str(counter) + ".")
+        yield self._outage_element(outage)
+
+    if incremental:
+      with open(output_file, 'w') as file:
+        with etree.xmlfile(file) as xf:
+          xf.write_declaration()
+          self._write_elements(xf, 'events', items())
+    else:
+      root = etree.Element('events')
+      tree = etree.ElementTree(root)
+      root.extend(items())
 
-      mod_time = etree.SubElement(item, 'mod_time')
-      mod_time.text = str(outage['mod_time'])
+      with open(output_file, 'w') as file:
+        # The "pretty_print" argument writes the XML in tree form.
+        tree.write(file, pretty_print=True, xml_declaration=True)
 
-    with open(output_file, 'w') as file:
-      # The "pretty_print" argument writes the XML in tree form.
-      tree.write(file, pretty_print=True, xml_declaration=True)
     self.hmdclog.log('debug', "")
     self.hmdclog.log('info', "Wrote " + output_file)
 
@@ -582,94 +1290,313 @@ class OSCalendarCache():
     Parameters:
       source (string): Filename with absolute path of the source file.
 
+    Returns:
+      outages (list): Resulting variables from the parsed calendar feed.
+    """
+
+    return list(self.iter_ical(source))
+
+  def prune_archive(self, archive_directory, max_age, max_size, now=None):
+    """Evicts runs of fetches last seen more than max_age ago from the
+    archive, then the oldest runs until the snapshots and fetches.log fit in
+    max_size. Snapshots no longer referenced by any run are deleted. The
+    latest run is always kept.
+
+    Parameters:
+      archive_directory (string): Location of the feed archive.
+      max_age (int): Oldest fetch to keep, in seconds; 0 for no limit.
+      max_size (int): Total size of the archive to keep, in bytes; 0 for no
+        limit.
+      now (int): Current time as a unix timestamp; defaults to the clock.
+
     Attributes:
-      counter (int): Numbers events for debugging.
-      desc (string): The 'description' from the calendar feed.
-      end_time (int): The 'end time' in unix format from the calendar feed.
-      link (string): The 'URL' from the calendar feed.
-      mod_time (int): The 'modified time' in unix format from the calendar feed.
-      resolved (boolean): If the outage is marked resolved is the description.
-      start_time (int): The 'start time' in unix format from the calendar feed.
-      title (string): The event 'title' from the calendar feed.
+      entries (list): (first seen, last seen, snapshot hash) tuples, oldest
+        first.
+      references (dictionary): Number of kept runs of each snapshot.
+      sizes (dictionary): Size of each referenced snapshot, in bytes.
+      total_size (int): Size of the referenced snapshots and the log, in
+        bytes.
+    """
 
-    Returns:
-      outages (dictionary): Resulting variables from the parsed calendar feed.
+    snapshot_directory = archive_directory + "/snapshots"
+    log_file = archive_directory + "/fetches.log"
+
+    if now is None:
+      now = int(time.time())
+
+    entries = self._read_archive_log(archive_directory)
+    kept = len(entries)
+
+    if max_age:
+      while len(entries) > 1 and entries[0][1] < now - max_age:
+        entries.pop(0)
+
+    references = {}
+    for first_seen, last_seen, digest in entries:
+      references[digest] = references.get(digest, 0) + 1
+
+    sizes = {}
+    for digest in references:
+      snapshot_file = snapshot_directory + "/" + digest + ".ics.gz"
+      if os.path.isfile(snapshot_file):
+        sizes[digest] = os.path.getsize(snapshot_file)
+      else:
+        sizes[digest] = 0
+    total_size = sum(sizes.values()) + len(entries) * ARCHIVE_LOG_LINE_LENGTH
+
+    if max_size:
+      while len(entries) > 1 and total_size > max_size:
+        first_seen, last_seen, digest = entries.pop(0)
+        total_size -= ARCHIVE_LOG_LINE_LENGTH
+        references[digest] -= 1
+        if not references[digest]:
+          del references[digest]
+          total_size -= sizes[digest]
+
+    if len(entries) != kept:
+      with open(log_file + ".tmp", 'w') as file:
+        for entry in entries:
+          file.write(ARCHIVE_LOG_LINE % entry)
+      shutil.move(log_file + ".tmp", log_file)
+      self.hmdclog.log('info', "Evicted " + str(kept - len(entries)) + " runs of fetches.")
+
+    #
+    # Only delete finished snapshots; ".tmp" files may belong to a run that
+    # is archiving right now.
+    #
+    if os.path.isdir(snapshot_directory):
+      for filename in os.listdir(snapshot_directory):
+        if not filename.endswith(".ics.gz"):
+          continue
+        if filename[:-len(".ics.gz")] not in references:
+          os.remove(snapshot_directory + "/" + filename)
+          self.hmdclog.log('debug', "Deleted snapshot: " + filename)
+
+  def publish_audience_shards(self, shard_directory, sorted_outages,
+                              notifications=None):
+    """Writes a notifications file for each audience holding only the outages
+    that apply to it, next to an index.json of the audiences published. A
+    shard is only rebuilt when its outages or the settings used to render
+    them (states, website_url, etc.) differ from the last run.
+
+    Parameters:
+      shard_directory (string): Location of the per-audience notifications.
+      sorted_outages (dictionary): Outages sorted into groups; None when
+        publishing the given notifications to every existing shard instead.
+      notifications (dictionary): Notifications for every shard, e.g. the
+        error state, used when sorted_outages is None.
+
+    Attributes:
+      index (dictionary): Outages sorted into groups, for each audience.
+      index_file (string): Full path to the index of published shards.
+      previous (dictionary): Signature of each shard from the last run.
+      shard_file (string): Full path to an audience's notifications.
+      signature (string): Hash of a shard's outages and the settings.
+      signatures (dictionary): Signature of each shard from this run.
     """
 
-    counter = 0
-    outages = []
+    index_file = shard_directory + "/index.json"
+
+    if not os.path.isdir(shard_directory):
+      os.makedirs(shard_directory)
 
-    if os.path.isfile(source):
-      with open(source, 'rb') as file:
-        ical_feed = Calendar.from_ical(file.read())
-      self.hmdclog.log('debug', "Read in file: " + source)
+    if os.path.isfile(index_file):
+      with open(index_file, 'r') as file:
+        previous = json.load(file)['shards']
     else:
-      raise Exception("Calendar feed not found!")
+      previous = {}
 
-    for component in ical_feed.walk():
-      if component.name == "VEVENT":
-        counter += 1
-        self.hmdclog.log('debug', "")
-        self.hmdclog.log('debug', "Begin parsing entry #" + str(counter) + ".")
+    if sorted_outages is None:
+      index = dict((audience, None) for audience in previous)
+    else:
+      index = self.index_audiences(sorted_outages, previous.keys())
 
-        desc = component.get("DESCRIPTION").encode('utf-8')
-        self.hmdclog.log('debug', "(Description parsed.)")
+    signatures = {}
+    for audience, members in sorted(index.items()):
+      shard_file = shard_directory + "/" + audience + ".xml"
 
-        end_time = component.get('DTEND').to_ical()
-        end_time = self.iso_to_unixtime("Endtime", end_time)
+      if members is None:
+        key = ('error', notifications['gui'])
+      else:
+        key = [(state, [(o['title'], o['link'], o['start_time'], o['end_time'],
+                         o['resolved']) for o in members[state]])
+               for state in ('completed', 'scheduled', 'active')]
+      signature = hashlib.sha1(repr((self.settings.digest, key))).hexdigest()
+      signatures[audience] = signature
+
+      if signature == previous.get(audience) and os.path.isfile(shard_file):
+        self.hmdclog.log('debug', "Shard unchanged: " + audience)
+        continue
+
+      if members is None:
+        shard_notifications = notifications
+      else:
+        shard_notifications = self.create_notifications(members)
 
-        link = component.get('URL')
-        self.hmdclog.log('debug', "URL: " + link)
+      self.notifications_to_xml(shard_notifications, shard_file + ".new",
+                                incremental=self.settings.incremental_xml)
+      shutil.move(shard_file + ".new", shard_file)
+      self.hmdclog.log('info', "Updated shard: " + audience)
 
-        mod_time = component.get('LAST-MODIFIED').to_ical()
-        mod_time = self.iso_to_unixtime("Modtime", mod_time)
+    with open(index_file + ".new", 'w') as file:
+      json.dump({'shards': signatures}, file, indent=2, sort_keys=True)
+    shutil.move(index_file + ".new", index_file)
 
-        resolved = self.is_resolved(desc)
-        self.hmdclog.log('debug', "Resolved: " + str(resolved))
+  def reload_settings(self):
+    """Reloads settings if the conf file's mtime and contents have changed,
+    so long running processes pick up changes without a restart. The logger
+    is rebuilt if debug_level or log_file changed. An invalid conf file is
+    logged and the current settings are kept.
 
-        start_time = component.get('DTSTART').to_ical()
-        start_time = self.iso_to_unixtime("Starttime", start_time)
+    Returns:
+      reloaded (boolean): If new settings were loaded.
+    """
 
-        title = component.get('SUMMARY').encode('utf-8')
-        title = self.sanitize_text("title", title)
+    try:
+      settings = OSCalendarSettings.load(self.CONFIG_FILE)
+    except Exception, e:
+      self.hmdclog.log('error', "Keeping current settings; " + self.CONFIG_FILE +
+                       " is invalid: " + str(e))
+      return False
 
-        self.hmdclog.log('debug', "Done parsing entry #" + str(counter) + ".")
+    if settings is self.settings:
+      return False
 
-        #
-        # If there's no end time defined, ICAL sets it to be equal to
-        # the start time, which we don't want -- so zero it out.
-        #
-        if end_time == start_time:
-          end_time = "0" * 10
-          self.hmdclog.log('debug', "Found matching start and end time.")
+    previous, self.settings = self.settings, settings
+
+    if (settings.debug_level, settings.log_file) != \
+       (previous.debug_level, previous.log_file):
+      # Remove only the handlers the old logger added, so the new logger
+      # doesn't duplicate them.
+      logger = logging.getLogger(self.__class__.__name__)
+      for handler in self.log_handlers:
+        logger.removeHandler(handler)
+        handler.close()
+      self.hmdclog = self._set_logger(*self.logger_options)
+
+    self.hmdclog.log('info', "Reloaded settings from " + self.CONFIG_FILE)
+    return True
 
-        outages.append({'end_time': end_time,
-                        'link': link,
-                        'mod_time': mod_time,
-                        'resolved': resolved,
-                        'start_time': start_time,
-                        'title': title})
+  def replay_snapshots(self, snapshot_directory, output_directory,
+                       expected_directory=None, record=False):
+    """Runs archived calendar feeds through parse_ical(), sort_outages(),
+    create_notifications() and notifications_to_xml() as if at the time they
+    were fetched, timing each step and comparing the results to expected
+    notifications files. Nothing is downloaded.
 
-    return outages
+    The snapshot directory is either a feed archive (see archive_feed()),
+    whose feeds are replayed at the times they were first and last seen, or
+    a directory of "<unixtime>.ics" or "<unixtime>.ics.gz" files.
+
+    Parameters:
+      snapshot_directory (string): Location of the snapshots.
+      output_directory (string): Location to write "<unixtime>.xml" files of
+        the notifications created from each snapshot.
+      expected_directory (string): Optional location of "<unixtime>.xml" files
+        to compare the notifications against.
+      record (boolean): Copy notifications into expected_directory when no
+        expected file exists yet, to create a baseline.
+
+    Attributes:
+      expected_file (string): Full path to the expected notifications file.
+      output_file (string): Full path to the notifications file.
+      runs (list): (fetch time, snapshot file) tuples, oldest first.
+      started (float): Timer value at the start of a step.
+
+    Returns:
+      results (list): For each run, a dictionary of the "fetched" time, the
+        "snapshot" file, "timings" per step in seconds, whether it "matched"
+        the expected file (None if there was none), the "diff" from it, and
+        any "error".
+    """
+
+    if os.path.isfile(snapshot_directory + "/fetches.log"):
+      # Replay each archived feed when it was first and last seen.
+      runs = []
+      for first_seen, last_seen, digest in self._read_archive_log(snapshot_directory):
+        snapshot = snapshot_directory + "/snapshots/" + digest + ".ics.gz"
+        runs.append((first_seen, snapshot))
+        if last_seen != first_seen:
+          runs.append((last_seen, snapshot))
+    else:
+      runs = []
+      for filename in os.listdir(snapshot_directory):
+        match = re.match(r'^(\d+)\.ics(\.gz)?$', filename)
+        if match:
+          runs.append((int(match.group(1)), snapshot_directory + "/" + filename))
+      runs.sort()
+
+    if not os.path.isdir(output_directory):
+      os.makedirs(output_directory)
+
+    results = []
+    for fetched, snapshot in runs:
+      result = {'diff': [], 'error': None, 'fetched': fetched, 'matched': None,
+                'snapshot': snapshot, 'timings': {}}
+      results.append(result)
+      output_file = output_directory + "/" + str(fetched) + ".xml"
+      self.hmdclog.log('info', "Replaying " + snapshot + " at " + str(fetched))
+
+      try:
+        started = timeit.default_timer()
+        outages = self.parse_ical(snapshot)
+        result['timings']['parse_ical'] = timeit.default_timer() - started
+
+        started = timeit.default_timer()
+        sorted_outages = self.sort_outages(outages, fetched)
+        result['timings']['sort_outages'] = timeit.default_timer() - started
+
+        started = timeit.default_timer()
+        notifications = self.create_notifications(sorted_outages)
+        result['timings']['create_notifications'] = timeit.default_timer() - started
+
+        started = timeit.default_timer()
+        self.notifications_to_xml(notifications, output_file,
+                                  incremental=self.settings.incremental_xml)
+        result['timings']['notifications_to_xml'] = timeit.default_timer() - started
+      except Exception, e:
+        self.hmdclog.log('error', "Replay of " + snapshot + " failed: " + str(e))
+        result['error'] = str(e)
+        continue
+
+      if expected_directory is None:
+        continue
+
+      expected_file = expected_directory + "/" + str(fetched) + ".xml"
+      if os.path.isfile(expected_file):
+        with open(expected_file, 'r') as file:
+          expected = file.readlines()
+        with open(output_file, 'r') as file:
+          actual = file.readlines()
+        result['diff'] = list(difflib.unified_diff(expected, actual,
+                                                   expected_file, output_file))
+        result['matched'] = not result['diff']
+      elif record:
+        if not os.path.isdir(expected_directory):
+          os.makedirs(expected_directory)
+        shutil.copy(output_file, expected_file)
+        self.hmdclog.log('info', "Recorded " + expected_file)
+
+    return results
 
   def sanitize_text(self, name, text):
     """Replaces non-alphanumeric characters with underscores."""
 
-    pattern = re.compile(r'[^\w\s]', re.MULTILINE)
-    subbed = re.sub(pattern, "_", str(text))
+    subbed = SANITIZE_PATTERN.sub("_", str(text))
     self.hmdclog.log('debug', "" + name + ": \"" + str(text) +
                      "\" converted to " + "\"" + str(subbed) + "\"")
     return subbed
 
-  def sort_outages(self, outages):
+  def sort_outages(self, outages, now=None):
     """Sorts outages into groups of "completed", "active", and "scheduled".
 
     Parameters:
       outages (dictionary): A list of outages from the calendar feed.
+      now (int): Time to sort the outages at as a unix timestamp; defaults to
+        the current date and time.
 
     Attributes:
       counter (int): Counts interations for debugging text.
-      now (int): Current date and time as a unix timestamp.
 
     Returns:
       sorted_outages (dictionary): Outages sorted into buckets of
@@ -678,7 +1605,8 @@ class OSCalendarCache():
 
     counter = 0
     sorted_outages = {'completed': [], 'scheduled': [], 'active': []}
-    now = int(time.time())
+    if now is None:
+      now = int(time.time())
 
     #
     # Iterate over each outage and sort it based on several factors.
@@ -720,8 +1648,8 @@ class OSCalendarCache():
       #
       # Determines if the outage fits into the defined scopes.
       #
-      within_future_scope = seconds_until_start < self.settings['scope_ahead']
-      within_past_scope = abs(seconds_until_end) < self.settings['scope_past']
+      within_future_scope = seconds_until_start < self.settings.scope_ahead
+      within_past_scope = abs(seconds_until_end) < self.settings.scope_past
       self.hmdclog.log('debug', "within future scope: " + str(within_future_scope))
       self.hmdclog.log('debug', "within past scope: " + str(within_past_scope))
 
@@ -774,6 +1702,63 @@ class OSCalendarCache():
 
     return sorted_outages
 
+  def timeline_outages(self, outages, timestamps):
+    """Evaluates the "completed", "active", and "scheduled" state of every
+    outage at every timestamp at once, using the same rules and scopes as
+    sort_outages() but as NumPy array operations instead of a Python loop
+    per timestamp.
+
+    Parameters:
+      outages (list): A list of outages from the calendar feed.
+      timestamps (list): Unix timestamps to evaluate the outages at.
+
+    Attributes:
+      end_times (array): End time of each outage (0 if undefined).
+      now (array): The timestamps as a column, broadcast against outages.
+      resolved (array): Whether each outage is marked resolved.
+      start_times (array): Start time of each outage.
+
+    Returns:
+      timeline (dictionary): Boolean arrays of shape (timestamps, outages) for
+        "completed", "active", and "scheduled"; an outage is in at most one
+        of them at any timestamp.
+    """
+
+    # NumPy is only needed here, so hosts that just cache the feed don't
+    # have to install it.
+    import numpy
+
+    start_times = numpy.array([int(o['start_time']) for o in outages], dtype=numpy.int64)
+    end_times = numpy.array([int(o['end_time']) for o in outages], dtype=numpy.int64)
+    resolved = numpy.array([bool(o['resolved']) for o in outages], dtype=bool)
+    now = numpy.asarray(timestamps, dtype=numpy.int64).reshape(-1, 1)
+
+    self.hmdclog.log('debug', "Evaluating " + str(len(start_times)) + " outages at " +
+                     str(len(now)) + " timestamps.")
+
+    seconds_until_start = start_times - now
+    seconds_until_end = end_times - now
+
+    has_started = seconds_until_start <= 0
+    has_ended = seconds_until_end <= 0
+    has_end_time = end_times != 0
+
+    if numpy.any(has_end_time & has_ended & ~has_started):
+      raise Exception("Event can't end without starting!")
+
+    within_future_scope = seconds_until_start < self.settings.scope_ahead
+    within_past_scope = numpy.abs(seconds_until_end) < self.settings.scope_past
+
+    #
+    # Same precedence as sort_outages(): active, then completed, then
+    # scheduled.
+    #
+    active = has_started & (~has_ended | ~has_end_time) & ~resolved
+    completed = ~active & ((has_started & has_ended) | resolved) & within_past_scope
+    scheduled = ~active & ~completed & ~has_started & ~resolved & within_future_scope
+
+    return {'completed': completed, 'scheduled': scheduled, 'active': active}
+
   def within_grace_period(self, cache_file, timeout):
     """Makes the cacher resilient to OpenScholar outages by allowing for
     connections to fail for a specified amount of time before throwing an error.
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+import ConfigParser
+import StringIO
+import hashlib
+import os
+import re
+
+__author__ = "Harvard-MIT Data Center DevOps"
+__copyright__ = "Copyright 2015, HMDC"
+__credits__ = ["Bradley Frank"]
+__license__ = "GPLv2"
+__maintainer__ = "HMDC"
+__email__ = "linux@lists.hmdc.harvard.edu"
+__status__ = "Production"
+
+
+class OSCalendarSettings():
+  """Validated snapshot of the OSCalendarCache conf file.
+
+  Every setting is parsed, typed and checked once when the snapshot is
+  created, so misconfigurations fail here instead of part way through
+  building notifications. Snapshots are cached per conf file and only
+  rebuilt when the file's mtime and contents change.
+
+  Example:
+    settings = OSCalendarSettings.load("/etc/os_calendar_cache.conf")
+    settings.scope_ahead
+    settings.states['active']['icon']
+
+  Private Functions:
+    _validate: Checks the parsed settings for sane values.
+
+  Public Functions:
+    changed: Checks whether the conf file differs from this snapshot.
+    load: Returns the cached snapshot of a conf file, reloading if changed.
+
+  Class Variables:
+    DEFAULTS (tuple): Section, option and value of optional settings.
+    STATES (tuple): Notification states that must be defined in [States].
+  """
+
+  # Settings added after 1.6.1 are optional so that existing conf files keep
+  # working; every feature they control is off by default.
+  DEFAULTS = (
+    ('Parsing', 'audience_property', 'CATEGORIES'),
+    ('Parsing', 'parallel_threshold', '0'),
+    ('Parsing', 'parallel_workers', '0'),
+    ('Sources', 'fetch_deadline', '0'),
+    ('Sources', 'stale_while_revalidate', 'false'),
+    ('WorkingFiles', 'archive_directory', ''),
+    ('WorkingFiles', 'archive_max_age', '2592000'),
+    ('WorkingFiles', 'archive_max_size', '104857600'),
+    ('WorkingFiles', 'audience_shards', 'false'),
+    ('WorkingFiles', 'compress_cache', 'false'),
+    ('WorkingFiles', 'incremental_xml', 'false'),
+  )
+
+  STATES = ('active', 'completed', 'default', 'error', 'none', 'scheduled')
+
+  # Snapshots of each conf file, keyed by path.
+  _snapshots = {}
+
+  def __init__(self, config_file):
+    """Parses the conf file into typed settings.
+
+    Parameters:
+      config_file (string): Full path to the conf file.
+
+    Attributes:
+      config_file (string): Full path to the conf file.
+      digest (string): SHA-1 hash of the conf file contents.
+      mtime (float): Last modified time of the conf file.
+      resolved_regex (object): Compiled regex for finding resolved outages.
+      states (dictionary): Icon, timeout and urgency for each state.
+    """
+
+    self.config_file = config_file
+    self.mtime = os.path.getmtime(config_file)
+
+    with open(config_file, 'r') as file:
+      contents = file.read()
+    self.digest = hashlib.sha1(contents).hexdigest()
+
+    # Parse the same bytes that were hashed, in case the file changes between
+    # reads.
+    config = ConfigParser.ConfigParser()
+    config.readfp(StringIO.StringIO(contents), config_file)
+
+    for section, option, value in self.DEFAULTS:
+      if not config.has_section(section):
+        config.add_section(section)
+      if not config.has_option(section, option):
+        config.set(section, option, value)
+
+    # Debugging
+    self.debug_level = config.get('Debugging', 'debug_level')
+    self.log_file = config.get('Debugging', 'log_file')
+    # Parsing
+    self.audience_property = config.get('Parsing', 'audience_property')
+    self.parallel_threshold = config.getint('Parsing', 'parallel_threshold')
+    self.parallel_workers = config.getint('Parsing', 'parallel_workers')
+    self.resolved_pattern = config.get('Parsing', 'resolved_pattern')
+    self.scope_ahead = config.getint('Parsing', 'scope_ahead')
+    self.scope_past = config.getint('Parsing', 'scope_past')
+    # States
+    self.states = {}
+    # Sources
+    self.feed_url = config.get('Sources', 'feed_url')
+    self.fetch_deadline = config.getint('Sources', 'fetch_deadline')
+    self.stale_while_revalidate = config.getboolean('Sources', 'stale_while_revalidate')
+    self.url_timeout = config.getint('Sources', 'url_timeout')
+    self.website_url = config.get('Sources', 'website_url')
+    # WorkingFiles
+    self.archive_directory = config.get('WorkingFiles', 'archive_directory')
+    self.archive_max_age = config.getint('WorkingFiles', 'archive_max_age')
+    self.archive_max_size = config.getint('WorkingFiles', 'archive_max_size')
+    self.audience_shards = config.getboolean('WorkingFiles', 'audience_shards')
+    self.compress_cache = config.getboolean('WorkingFiles', 'compress_cache')
+    self.incremental_xml = config.getboolean('WorkingFiles', 'incremental_xml')
+    self.working_directory = config.get('WorkingFiles', 'working_directory')
+
+    for state in self.STATES:
+      fields = config.get('States', state).split(':')
+      if len(fields) != 3:
+        raise Exception("State \"" + state + "\" must be icon:timeout:urgency.")
+      icon, timeout, urgency = fields
+      try:
+        timeout = int(timeout)
+      except ValueError:
+        raise Exception("State \"" + state + "\" timeout must be an integer.")
+      self.states[state] = {
+        'icon': icon,
+        'timeout': timeout,
+        'urgency': urgency
+      }
+
+    try:
+      self.resolved_regex = re.compile("(.*)(" + self.resolved_pattern + ")(.*)",
+                                       re.MULTILINE)
+    except re.error, e:
+      raise Exception("Invalid resolved_pattern: " + str(e))
+
+    self._validate()
+
+  def _validate(self):
+    """Checks the parsed settings for sane values."""
+
+    for name in ('archive_max_age', 'archive_max_size', 'fetch_deadline',
+                 'parallel_threshold', 'parallel_workers', 'scope_ahead',
+                 'scope_past', 'url_timeout'):
+      if getattr(self, name) < 0:
+        raise Exception("Setting \"" + name + "\" can't be negative.")
+
+    for name in ('audience_property', 'feed_url', 'resolved_pattern',
+                 'working_directory'):
+      if not getattr(self, name):
+        raise Exception("Setting \"" + name + "\" can't be empty.")
+
+    if not re.match(r'^https?://', self.feed_url):
+      raise Exception("Setting \"feed_url\" must be an http(s) URL.")
+
+    for state, values in self.states.items():
+      if not values['icon'] or not values['urgency'] or values['timeout'] < 0:
+        raise Exception("State \"" + state + "\" is incomplete or negative.")
+
+  def changed(self):
+    """Checks whether the conf file differs from this snapshot. The file is
+    only hashed when its mtime has moved.
+
+    Returns:
+      changed (boolean): If the conf file's contents have changed.
+    """
+
+    mtime = os.path.getmtime(self.config_file)
+    if mtime == self.mtime:
+      return False
+
+    with open(self.config_file, 'r') as file:
+      digest = hashlib.sha1(file.read()).hexdigest()
+
+    if digest == self.digest:
+      # Touched but not edited; skip hashing it again next time.
+      self.mtime = mtime
+      return False
+
+    return True
+
+  @classmethod
+  def load(cls, config_file):
+    """Returns the snapshot of a conf file, parsing it again only if the file
+    has changed since it was last loaded. Raises if the conf file is invalid;
+    the previous snapshot stays cached.
+
+    Parameters:
+      config_file (string): Full path to the conf file.
+
+    Returns:
+      settings (instance): Snapshot of the conf file.
+    """
+
+    settings = cls._snapshots.get(config_file)
+    if settings is not None and not settings.changed():
+      return settings
+
+    settings = cls(config_file)
+    cls._snapshots[config_file] = settings
+    return settings
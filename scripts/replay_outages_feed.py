@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+from os_calendar_cache import OSCalendarCache
+import argparse
+import sys
+import tempfile
+
+parser = argparse.ArgumentParser(
+  description="Replays archived calendar feeds through the notifications "
+              "pipeline at their fetch times, without any network access.")
+parser.add_argument('snapshots',
+                    help="feed archive, or directory of <unixtime>.ics[.gz] files")
+parser.add_argument('-c', '--config', default=OSCalendarCache.CONFIG_FILE,
+                    help="conf file to read settings from")
+parser.add_argument('-d', '--debug-level', default='WARNING',
+                    help="logging level for the console")
+parser.add_argument('-e', '--expected',
+                    help="directory of expected <unixtime>.xml notifications")
+parser.add_argument('-o', '--output', default=None,
+                    help="directory to write <unixtime>.xml notifications to")
+parser.add_argument('-r', '--record', action='store_true',
+                    help="save notifications as expected where none exist")
+args = parser.parse_args()
+
+OSCalendarCache.CONFIG_FILE = args.config
+cacher = OSCalendarCache(args.debug_level, log_to_console=True)
+output = args.output or tempfile.mkdtemp(prefix='os_calendar_cache-')
+results = cacher.replay_snapshots(args.snapshots, output, args.expected, args.record)
+
+steps = ('parse_ical', 'sort_outages', 'create_notifications', 'notifications_to_xml')
+failed = False
+
+print "%-12s %s %10s  %s" % ("fetched", " ".join("%12s" % step[:12] for step in steps),
+                             "total", "result")
+for result in results:
+  timings = result['timings']
+  if result['error'] is not None:
+    outcome = "error: " + result['error']
+    failed = True
+  elif result['matched'] is None:
+    outcome = "no baseline"
+  elif result['matched']:
+    outcome = "ok"
+  else:
+    outcome = "differs"
+    failed = True
+
+  print "%-12d %s %10.4f  %s" % (result['fetched'],
+                                 " ".join("%12.4f" % timings.get(step, 0) for step in steps),
+                                 sum(timings.values()), outcome)
+  sys.stdout.writelines(result['diff'])
+
+print "Notifications written to " + output
+sys.exit(1 if failed else 0)
@@ -10,22 +10,38 @@ setup(author='Bradley Frank',
       name='OSCalendarCache',
       packages=['os_calendar_cache'],
       requires=[
+           'argparse',
            'bs4',
            'ConfigParser',
            'datetime',
            'dateutil',
+           'difflib',
            'filecmp',
+           'gzip',
+           'hashlib',
+           'httplib',
            'icalendar',
+           'json',
+           'logging',
            'lxml',
+           'multiprocessing',
            'os',
            'pytz',
            're',
            'shutil',
+           'signal',
+           'socket',
+           'StringIO',
            'sys',
+           'tempfile',
            'termcolor',
            'time',
-           'urllib2'],
-      scripts=['scripts/cache_outages_feed.py'],
+           'timeit',
+           'urllib2',
+           'zlib'],
+      scripts=[
+           'scripts/cache_outages_feed.py',
+           'scripts/replay_outages_feed.py'],
       url='https://github.com/hmdc/os_calendar_cache',
       version='1.6.1',
 )